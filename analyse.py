@@ -10,8 +10,7 @@ from utils.metric import measure_metrics, MetricReporter
 
 def analyse_output(inference_output_dir, save_dir, metric_groups):
     print("Running output analysis:")
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    os.makedirs(save_dir, exist_ok=True)
 
     metric_reporter = MetricReporter(id_list=os.listdir(inference_output_dir),
                                      save_dir=save_dir)
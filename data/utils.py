@@ -95,17 +95,29 @@ def _magic_slicer(data_dict, slice_range=None, slicing=None):
     return data_dict
 
 
-def _load2d(data_path_dict):
+def _load_unique(data_path_dict):
+    """ Load data files with each distinct path loaded only once
+    (e.g. `target_original` and `source` can point to the same file) """
+    loaded = dict()
     data_dict = dict()
     for name, data_path in data_path_dict.items():
+        if data_path not in loaded:
+            loaded[data_path] = load_nifti(data_path)
+        data_dict[name] = loaded[data_path]
+    return data_dict
+
+
+def _load2d(data_path_dict):
+    data_dict = _load_unique(data_path_dict)
+    for name, data in data_dict.items():
         # image is saved in shape (H, W, N) ->  (N, H, W)
-        data_dict[name] = load_nifti(data_path).transpose(2, 0, 1)
+        data_dict[name] = data.transpose(2, 0, 1)
     return data_dict
 
 
 def _load3d(data_path_dict):
-    data_dict = dict()
-    for name, data_path in data_path_dict.items():
+    data_dict = _load_unique(data_path_dict)
+    for name, data in data_dict.items():
         # image is saved in shape (H, W, D) -> (ch=1, H, W, D)
-        data_dict[name] = load_nifti(data_path)[np.newaxis, ...]
+        data_dict[name] = data[np.newaxis, ...]
     return data_dict
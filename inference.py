@@ -1,5 +1,6 @@
 """Run model inference and save outputs for analysis"""
 import os
+from concurrent.futures import ThreadPoolExecutor
 import hydra
 from omegaconf import DictConfig
 from tqdm import tqdm
@@ -11,8 +12,8 @@ from torch.utils.data import DataLoader
 from data.datasets import BrainMRInterSubj3D, CardiacMR2D
 from model.lightning import LightningDLReg
 from model.baselines import Identity, MIRTK
-from model.transformation import warp
-from utils.image_io import save_nifti
+from model.transformation import warped_grid, warp_stacked
+from utils.image_io import save_nifti_async
 from utils.misc import setup_dir
 from analyse import analyse_output
 
@@ -51,38 +52,75 @@ def get_inference_model(cfg, device=torch.device('cpu')):
     return model
 
 
+@torch.no_grad()
 def inference(model, dataloader, output_dir, device=torch.device('cpu')):
-    for idx, batch in enumerate(tqdm(dataloader)):
-        for k, x in batch.items():
-            # reshape data for inference
-            # 2d: (N=1, num_slices, H, W) -> (num_slices, N=1, H, W)
-            # 3d: (N=1, 1, H, W, D) -> (1, N=1, H, W, D)
-            batch[k] = x.transpose(0, 1).to(device=device)
-
-        # model inference
-        out = model(batch['target'], batch['source'])
-        batch['disp_pred'] = out[1] if len(out) == 2 else out  # (flow, disp) or disp
-
-        # warp images and segmentation using predicted disp
-        batch['warped_source'] = warp(batch['source'], batch['disp_pred'])
-        if 'source_seg' in batch.keys():
-            batch['warped_source_seg'] = warp(batch['source_seg'], batch['disp_pred'],
-                                              interp_mode='nearest')
-        if 'target_original' in batch.keys():
-            batch['target_pred'] = warp(batch['target_original'], batch['disp_pred'])
-
-        # save the outputs
-        subj_id = dataloader.dataset.subject_list[idx]
-        output_id_dir = setup_dir(output_dir + f'/{subj_id}')
-        for k, x in batch.items():
-            x = x.detach().cpu().numpy()
+    # compress and write output files in parallel threads,
+    # overlapping with the inference of the next batch
+    # (use the CPU cores left over by the DataLoader workers)
+    num_save_workers = max(1, os.cpu_count() - dataloader.num_workers)
+    with ThreadPoolExecutor(max_workers=num_save_workers) as save_executor:
+        save_futures = []
+
+        for idx, batch in enumerate(tqdm(dataloader)):
+            # subjects in this batch (the last batch can be smaller)
+            num_subj = batch['target'].shape[0]
+            start = idx * dataloader.batch_size
+            subj_ids = dataloader.dataset.subject_list[start:start + num_subj]
+
+            for k, x in batch.items():
+                # reshape data for inference, subjects are stacked in dim 0
+                # 2d: (N, num_slices, H, W) -> (N*num_slices, 1, H, W)
+                # 3d: (N, 1, H, W, D) -> (N, 1, H, W, D)
+                batch[k] = x.reshape(-1, 1, *x.shape[2:]).to(device=device, non_blocking=True)
+
+            # model inference
+            out = model(batch['target'], batch['source'])
+            batch['disp_pred'] = out[1] if isinstance(out, tuple) else out  # (flow, disp) or disp
+
+            # warp images and segmentation using predicted disp
+            # (sampling grid is shared, images are warped together in one pass)
+            grid = warped_grid(batch['disp_pred'].type_as(batch['source']))
+            warp_keys = {'source': 'warped_source', 'target_original': 'target_pred'}
+            img_keys = [k for k in warp_keys if k in batch.keys()]
+            # target_original is the same image as source in mono-modal data, warp it only once
+            target_original_is_source = ('target_original' in img_keys
+                                         and torch.equal(batch['target_original'], batch['source']))
+            if target_original_is_source:
+                img_keys.remove('target_original')
+            warped_imgs = warp_stacked([batch[k] for k in img_keys], grid)
+            for k, x in zip(img_keys, warped_imgs):
+                batch[warp_keys[k]] = x
+            if target_original_is_source:
+                batch['target_pred'] = batch['warped_source']
+            if 'source_seg' in batch.keys():
+                batch['warped_source_seg'] = warp_stacked([batch['source_seg']], grid,
+                                                          interp_mode='nearest')[0]
+
+            # save the outputs
+            output_id_dirs = [setup_dir(output_dir + f'/{subj_id}') for subj_id in subj_ids]
             # reshape for saving:
             # 2D: img (N=num_slice, 1, H, W) -> (H, W, N);
             #     disp (N=num_slice, 2, H, W) -> (H, W, N, 2)
             # 3D: img (N=1, 1, H, W, D) -> (H, W, D);
             #     disp (N=1, 3, H, W, D) -> (H, W, D, 3)
-            x = np.moveaxis(x, [0, 1], [-2, -1]).squeeze()
-            save_nifti(x, path=output_id_dir + f'/{k}.nii.gz')
+            ndim = batch['target'].ndim - 2
+            save_perm = (*range(2, ndim + 2), 0, 1)
+            batch_save_futures = []
+            for k, x in batch.items():
+                # split the stacked subjects (N*num_slices, ch, *sizes) -> N x (num_slices, ch, *sizes)
+                x = x.detach().cpu().numpy()
+                for output_id_dir, x_subj in zip(output_id_dirs, np.split(x, num_subj)):
+                    x_subj = np.ascontiguousarray(x_subj.transpose(save_perm)).squeeze()
+                    batch_save_futures.append(save_nifti_async(x_subj, output_id_dir + f'/{k}.nii.gz',
+                                                               save_executor))
+
+            # wait for the previous batch to be saved, at most two batches are held in memory
+            for f in save_futures:
+                f.result()  # re-raise any saving error
+            save_futures = batch_save_futures
+
+        for f in save_futures:
+            f.result()
 
 
 @hydra.main(config_path="conf_inference", config_name="config")
@@ -97,8 +135,13 @@ def main(cfg: DictConfig) -> None:
     else:
         device = torch.device('cpu')
 
+    # MIRTK registers one subject per call
+    if cfg.model.type == 'mirtk' and cfg.data.dataloader.batch_size > 1:
+        raise ValueError(f'MIRTK inference only supports batch_size=1, '
+                         f'got {cfg.data.dataloader.batch_size}')
+
     # configure dataset & model
-    dataloader = get_inference_dataloader(cfg, pin_memory=(device is torch.device('cuda')))
+    dataloader = get_inference_dataloader(cfg, pin_memory=(device.type == 'cuda'))
     model = get_inference_model(cfg, device=device)
 
     # run inference
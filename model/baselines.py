@@ -106,6 +106,10 @@ class MIRTK(object):
     def register3d(self, tar, src):
         """Execute MIRTK registration of a volume pair,
          input/return Tensors shape (N, 3, H, W, D)"""
+        # only one 3D volume pair is registered per call
+        assert tar.shape[0] == 1 and src.shape[0] == 1, \
+            f"MIRTK 3D registration only supports batch_size=1, got {tar.shape[0]}"
+
         # save the target and source image to work_dir
         tar_path = self.work_dir + "/tar.nii.gz"
         save_nifti(tar.cpu().numpy()[0, 0, ...], tar_path)
@@ -121,8 +125,7 @@ class MIRTK(object):
         ndim = tar.ndim - 2
 
         # set up work_dir
-        if not os.path.exists(self.work_dir):
-            os.makedirs(self.work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
 
         # perform registration
         if ndim == 2:
@@ -1,12 +1,12 @@
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torch.optim import Adam
 
-from model.transformation import warp
+from model.transformation import warp, warped_grid, warp_stacked
 from model.utils import get_network, get_transformation, get_loss_fn, get_datasets
 from utils.misc import worker_init_fn
 from pytorch_lightning import LightningModule
-from pytorch_lightning.loggers.base import merge_dicts
 from utils.metric import measure_metrics
 from utils.visualise import visualise_result
 
@@ -102,15 +102,22 @@ class LightningDLReg(LightningModule):
         # collect data for measuring metrics and validation visualisation
         val_data = batch
         val_data.update(step_outputs)
+        # sampling grid of the predicted disp is shared by the warps below
+        grid = warped_grid(val_data['disp_pred'].type_as(batch['source']))
         if 'source_seg' in batch.keys():
-            val_data['warped_source_seg'] = warp(batch['source_seg'], val_data['disp_pred'],
-                                                 interp_mode='nearest')
+            val_data['warped_source_seg'] = warp_stacked([batch['source_seg']], grid,
+                                                         interp_mode='nearest')[0]
         if 'target_original' in batch.keys():
-            val_data['target_pred'] = warp(val_data['target_original'], val_data['disp_pred'])
+            if torch.equal(val_data['target_original'], val_data['source']):
+                # same image as source (e.g. mono-modal), reuse the warped source
+                val_data['target_pred'] = val_data['warped_source']
+            else:
+                val_data['target_pred'] = warp_stacked([val_data['target_original']], grid)[0]
 
         # calculate validation metrics
-        val_metrics = {k: float(loss.cpu())
-                       for k, loss in val_losses.items()}
+        # (losses are copied to CPU together in one transfer)
+        val_loss_values = torch.stack(list(val_losses.values())).cpu().tolist()
+        val_metrics = dict(zip(val_losses.keys(), val_loss_values))
         val_metrics.update(measure_metrics(val_data, self.hparams.metric_groups))
 
         # log visualisation figure to Tensorboard
@@ -124,7 +131,14 @@ class LightningDLReg(LightningModule):
 
     def validation_epoch_end(self, val_metrics):
         """ Process and log accumulated validation results in one epoch """
-        val_metrics_epoch = merge_dicts(val_metrics)
+        # stack into (num_batches, num_metrics) to average all metrics at once
+        # (metrics missing in some batches, e.g. absent label classes, are masked out of the average)
+        metric_names = list(dict.fromkeys(k for m in val_metrics for k in m.keys()))
+        val_metrics_stacked = np.array([[m.get(k, 0.) for k in metric_names]
+                                        for m in val_metrics])
+        present = np.array([[k in m for k in metric_names] for m in val_metrics])
+        val_metrics_mean = (val_metrics_stacked * present).sum(axis=0) / present.sum(axis=0)
+        val_metrics_epoch = dict(zip(metric_names, val_metrics_mean))
         self.log_dict({f'val_metrics/{k}': metric
                        for k, metric in val_metrics_epoch.items()})
 
@@ -40,7 +40,9 @@ class MILossGaussian(nn.Module):
                  vmax=1.0,
                  num_bins=64,
                  sample_ratio=0.1,
-                 normalised=True
+                 normalised=True,
+                 chunk_size=2 ** 16,
+                 fast=False
                  ):
         super(MILossGaussian, self).__init__()
 
@@ -48,37 +50,54 @@ class MILossGaussian(nn.Module):
         self.vmax = vmax
         self.sample_ratio = sample_ratio
         self.normalised = normalised
+        self.chunk_size = chunk_size
+
+        # approximate the Gaussian window by linear (triangle) window of 2-bin support,
+        # trading the dense KDE for a sparse scattered joint histogram
+        self.fast = fast
 
         # set the std of Gaussian kernel so that FWHM is one bin width
         bin_width = (vmax - vmin) / num_bins
         self.sigma = bin_width * (1/(2 * math.sqrt(2 * math.log(2))))
+        self._inv_2sig2 = 1. / (2 * self.sigma ** 2)
 
         # set bin edges
         self.num_bins = num_bins
         self.bins = torch.linspace(self.vmin, self.vmax, self.num_bins, requires_grad=False).unsqueeze(1)
 
+    def _apply(self, fn, *args, **kwargs):
+        # move/cast bins together with the module (e.g. by `.to()` or `.cuda()`) instead of on every call,
+        # bins are not registered as a buffer to keep them out of the checkpoint state_dict
+        super(MILossGaussian, self)._apply(fn, *args, **kwargs)
+        self.bins = fn(self.bins)
+        return self
+
     def _compute_joint_prob(self, x, y):
         """
         Compute joint distribution and entropy
         Input shapes (N, 1, prod(sizes))
         """
-        # cast bins
-        self.bins = self.bins.type_as(x)
-
-        # calculate Parzen window function response (N, #bins, H*W*D)
-        win_x = torch.exp(-(x - self.bins) ** 2 / (2 * self.sigma ** 2))
-        win_x = win_x / (math.sqrt(2 * math.pi) * self.sigma)
-        win_y = torch.exp(-(y - self.bins) ** 2 / (2 * self.sigma ** 2))
-        win_y = win_y / (math.sqrt(2 * math.pi) * self.sigma)
-
-        # calculate joint histogram batch
-        hist_joint = win_x.bmm(win_y.transpose(1, 2))  # (N, #bins, #bins)
-
-        # normalise joint histogram to get joint distribution
-        hist_norm = hist_joint.flatten(start_dim=1, end_dim=-1).sum(dim=1) + 1e-5
-        p_joint = hist_joint / hist_norm.view(-1, 1, 1)  # (N, #bins, #bins) / (N, 1, 1)
-
-        return p_joint
+        if self.fast:
+            # linear window on the 2 nearest bin centres
+            bin_spacing = (self.vmax - self.vmin) / (self.num_bins - 1)
+            idx_x, win_x = linear_window(x[:, 0, :], self.vmin, bin_spacing, self.num_bins)
+            idx_y, win_y = linear_window(y[:, 0, :], self.vmin, bin_spacing, self.num_bins)
+            hist_joint = scatter_joint_hist(idx_x, win_x, idx_y, win_y, self.num_bins)
+            return normalise_joint_hist(hist_joint)
+
+        # calculate joint histogram batch (N, #bins, #bins)
+        # accumulated over chunks of points so that the Parzen window response
+        # is not materialised as one (N, #bins, H*W*D) tensor
+        hist_joint = x.new_zeros(x.size()[0], self.num_bins, self.num_bins)
+        for x_chunk, y_chunk in zip(x.split(self.chunk_size, dim=2), y.split(self.chunk_size, dim=2)):
+            # calculate Parzen window function response (N, #bins, chunk_size)
+            # (the Gaussian normalising constant is omitted as it cancels out in histogram normalisation)
+            win_x = torch.exp(-(x_chunk - self.bins) ** 2 * self._inv_2sig2)
+            win_y = torch.exp(-(y_chunk - self.bins) ** 2 * self._inv_2sig2)
+
+            hist_joint = hist_joint.baddbmm(win_x, win_y.transpose(1, 2))
+
+        return normalise_joint_hist(hist_joint)
 
     def forward(self, x, y):
         """
@@ -114,9 +133,9 @@ class MILossGaussian(nn.Module):
         p_y = torch.sum(p_joint, dim=1)
 
         # calculate entropy
-        ent_x = - torch.sum(p_x * torch.log(p_x + 1e-5), dim=1)  # (N,1)
-        ent_y = - torch.sum(p_y * torch.log(p_y + 1e-5), dim=1)  # (N,1)
-        ent_joint = - torch.sum(p_joint * torch.log(p_joint + 1e-5), dim=(1, 2))  # (N,1)
+        ent_x = entropy(p_x, dim=1)  # (N,1)
+        ent_y = entropy(p_y, dim=1)  # (N,1)
+        ent_joint = entropy(p_joint, dim=(1, 2))  # (N,1)
 
         if self.normalised:
             return -torch.mean((ent_x + ent_y) / ent_joint)
@@ -124,6 +143,128 @@ class MILossGaussian(nn.Module):
             return -torch.mean(ent_x + ent_y - ent_joint)
 
 
+class MILossBSpline(MILossGaussian):
+    """
+    Mutual information loss using cubic B-spline kernel in KDE.
+    The kernel has a compact support of 4 bins, so each point only contributes to
+    4x4 bins of the joint histogram, which is accumulated by scattering instead of
+    a dense product over all bins.
+    """
+    def __init__(self,
+                 vmin=0.0,
+                 vmax=1.0,
+                 num_bins=64,
+                 sample_ratio=0.1,
+                 normalised=True
+                 ):
+        super(MILossBSpline, self).__init__(vmin=vmin,
+                                            vmax=vmax,
+                                            num_bins=num_bins,
+                                            sample_ratio=sample_ratio,
+                                            normalised=normalised)
+        # bin centres are spaced evenly from vmin to vmax
+        self.bin_width = (vmax - vmin) / (num_bins - 1)
+
+    def _compute_joint_prob(self, x, y):
+        """
+        Compute joint distribution
+        Input shapes (N, 1, prod(sizes))
+        """
+        idx_x, win_x = bspline_window(x[:, 0, :], self.vmin, self.bin_width, self.num_bins)
+        idx_y, win_y = bspline_window(y[:, 0, :], self.vmin, self.bin_width, self.num_bins)
+
+        # the support extends 1 bin below the first and 2 bins above the last bin centre
+        hist_joint = scatter_joint_hist(idx_x, win_x, idx_y, win_y, self.num_bins + 3)
+        return normalise_joint_hist(hist_joint)
+
+
+def linear_window(x, vmin, bin_width, num_bins):
+    """
+    Linear (triangle) window function response on the 2 bins in its support
+
+    Args:
+        x: (Tensor, shape (N, P)) intensity values
+        vmin: (float) centre of the first bin
+        bin_width: (float) distance between bin centres
+        num_bins: (int) number of bins
+
+    Returns:
+        idx: (list of 2 LongTensors, shape (N, P)) bin indices
+        win: (list of 2 Tensors, shape (N, P)) window function response on each bin
+    """
+    # position in unit of bins, the lower bin and position within the bin
+    pos = ((x - vmin) / bin_width).clamp(0, num_bins - 1)
+    idx0 = pos.detach().floor().clamp(max=num_bins - 2)
+    t = pos - idx0
+
+    win = [1 - t, t]
+    idx = [idx0.long() + i for i in range(2)]
+    return idx, win
+
+
+def bspline_window(x, vmin, bin_width, num_bins):
+    """
+    Cubic B-spline window function response on the 4 bins in its support
+
+    Args:
+        x: (Tensor, shape (N, P)) intensity values
+        vmin: (float) centre of the first bin
+        bin_width: (float) distance between bin centres
+        num_bins: (int) number of bins
+
+    Returns:
+        idx: (list of 4 LongTensors, shape (N, P)) bin indices, offset by 1 to start from 0
+        win: (list of 4 Tensors, shape (N, P)) window function response on each bin
+    """
+    # position in unit of bins, first bin in the support and position within the bin
+    pos = ((x - vmin) / bin_width).clamp(0, num_bins - 1)
+    idx0 = pos.detach().floor()
+    t = pos - idx0
+
+    # cubic B-spline values at distances (1 + t, t, 1 - t, 2 - t)
+    win = [(1 - t) ** 3 / 6,
+           (3 * t ** 3 - 6 * t ** 2 + 4) / 6,
+           (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6,
+           t ** 3 / 6]
+    idx = [idx0.long() + i for i in range(4)]
+    return idx, win
+
+
+def scatter_joint_hist(idx_x, win_x, idx_y, win_y, num_bins):
+    """
+    Joint histogram from window functions of compact support,
+    by scattering the response of every pair of bins in the supports
+
+    Args:
+        idx_x, idx_y: (list of LongTensors, shape (N, P)) bin indices of the window supports
+        win_x, win_y: (list of Tensors, shape (N, P)) window function responses on the bins
+        num_bins: (int) number of bins of the histogram
+
+    Returns:
+        hist_joint: (Tensor, shape (N, #bins, #bins))
+    """
+    hist_joint = win_x[0].new_zeros(win_x[0].size()[0], num_bins * num_bins)
+    for ix, wx in zip(idx_x, win_x):
+        for iy, wy in zip(idx_y, win_y):
+            hist_joint = hist_joint.scatter_add(1, ix * num_bins + iy, wx * wy)
+    return hist_joint.view(-1, num_bins, num_bins)
+
+
+def entropy(p, dim):
+    """
+    Entropy of discrete distribution -sum(p * log(p)), with 0 * log(0) taken as 0.
+    Log is evaluated on p clamped to a tiny value rather than on p + eps,
+    so that the entropy is not biased for small probabilities.
+    """
+    return - torch.sum(p * torch.log(p.clamp(min=1e-10)), dim=dim)
+
+
+def normalise_joint_hist(hist_joint):
+    """ Normalise joint histogram (N, #bins, #bins) to get joint distribution """
+    hist_norm = hist_joint.flatten(start_dim=1, end_dim=-1).sum(dim=1) + 1e-5
+    return hist_joint / hist_norm.view(-1, 1, 1)  # (N, #bins, #bins) / (N, 1, 1)
+
+
 class LNCCLoss(nn.Module):
     """
     Local Normalized Cross Correlation loss
@@ -135,43 +276,56 @@ class LNCCLoss(nn.Module):
         self.window_size = window_size
 
     def forward(self, x, y):
-        # products and squares
-        xsq = x * x
-        ysq = y * y
-        xy = x * y
-
         # set window size
         ndim = x.dim() - 2
         window_size = param_ndim_setup(self.window_size, ndim)
 
-        # summation filter for convolution
-        sum_filt = torch.ones(1, 1, *window_size).type_as(x)
+        # summing images, squares and products over window,
+        # the box filter is separable so it is applied along each dimension in turn
+        sums = torch.cat([x, y, x * x, y * y, x * y], dim=1)  # (N, 5, *sizes)
+        for i in range(ndim):
+            sums = window_sum(sums, dim=i + 2, window_size=window_size[i])
+        x_sum, y_sum, xsq_sum, ysq_sum, xy_sum = sums.split(1, dim=1)
 
-        # set stride and padding
-        stride = (1,) * ndim
-        padding = tuple([math.floor(window_size[i]/2) for i in range(ndim)])
+        window_num_points = float(np.prod(window_size))
+        lncc = _lncc_from_sums(x_sum, y_sum, xsq_sum, ysq_sum, xy_sum, window_num_points)
 
-        # get convolution function of the correct dimension
-        conv_fn = getattr(F, f'conv{ndim}d')
-
-        # summing over window by convolution
-        x_sum = conv_fn(x, sum_filt, stride=stride, padding=padding)
-        y_sum = conv_fn(y, sum_filt, stride=stride, padding=padding)
-        xsq_sum = conv_fn(xsq, sum_filt, stride=stride, padding=padding)
-        ysq_sum = conv_fn(ysq, sum_filt, stride=stride, padding=padding)
-        xy_sum = conv_fn(xy, sum_filt, stride=stride, padding=padding)
+        return -torch.mean(lncc)
 
-        window_num_points = np.prod(window_size)
-        x_mu = x_sum / window_num_points
-        y_mu = y_sum / window_num_points
 
-        cov = xy_sum - y_mu * x_sum - x_mu * y_sum + x_mu * y_mu * window_num_points
-        x_var = xsq_sum - 2 * x_mu * x_sum + x_mu * x_mu * window_num_points
-        y_var = ysq_sum - 2 * y_mu * y_sum + y_mu * y_mu * window_num_points
+def window_sum(x, dim, window_size):
+    """
+    Sum over a sliding window along one dimension by the difference of cumulative sums,
+    the cost per point is independent of the window size.
+    Same as convolving with a box filter of `window_size` and zero-padding of floor(window_size/2).
 
-        lncc = cov * cov / (x_var * y_var + 1e-5)
+    Args:
+        x: (Tensor, shape (N, ch, *sizes))
+        dim: (int) dimension to sum along
+        window_size: (int) size of the window
 
-        return -torch.mean(lncc)
+    Returns:
+        (Tensor) window sums, same shape as x for odd window sizes
+    """
+    pad = math.floor(window_size / 2)
+    # zero-pad one more point before so that the first window sum is a difference to 0
+    paddings = [0, 0] * (x.ndim - 1 - dim) + [pad + 1, pad]
+    x_cumsum = F.pad(x, paddings).cumsum(dim)
+    out_size = x_cumsum.size(dim) - window_size
+    return x_cumsum.narrow(dim, window_size, out_size) - x_cumsum.narrow(dim, 0, out_size)
+
+
+@torch.jit.script
+def _lncc_from_sums(x_sum, y_sum, xsq_sum, ysq_sum, xy_sum, window_num_points: float):
+    """ Point-wise LNCC from local window sums (scripted to fuse the element-wise ops) """
+    # (co)variances (scaled by the number of points in window) in the form of
+    # sum(xy) - sum(x) * sum(y) / N
+    x_mu = x_sum / window_num_points
+    y_mu = y_sum / window_num_points
+    cov = xy_sum - x_mu * y_sum
+    x_var = xsq_sum - x_mu * x_sum
+    y_var = ysq_sum - y_mu * y_sum
+    return cov * cov / (x_var * y_var + 1e-5)
 
 
 def l2reg_loss(u):
@@ -240,8 +394,7 @@ def finite_diff(x, dim, mode="forward", boundary="Neumann"):
         else:
             raise ValueError("Boundary condition not recognised.")
 
-        # slice and subtract
-        x_diff = x_pad.index_select(dim + 2, torch.arange(1, sizes[dim] + 1).to(device=x.device)) \
-                 - x_pad.index_select(dim + 2, torch.arange(0, sizes[dim]).to(device=x.device))
+        # slice (by views) and subtract
+        x_diff = x_pad.narrow(dim + 2, 1, sizes[dim]) - x_pad.narrow(dim + 2, 0, sizes[dim])
 
         return x_diff
@@ -218,21 +218,18 @@ def conv1d(
     return result
 
 
-def warp(x, disp, interp_mode="bilinear"):
+def warped_grid(disp):
     """
-    Spatially transform an image by sampling at transformed locations (2D and 3D)
+    Generate the sampling grid of grid_sample() from a dense disp field (2D and 3D)
 
     Args:
-        x: (Tensor float, shape (N, ndim, *sizes)) input image
         disp: (Tensor float, shape (N, ndim, *sizes)) dense disp field in i-j-k order (NOT spatially normalised)
-        interp_mode: (string) mode of interpolation in grid_sample()
 
     Returns:
-        deformed x, Tensor of the same shape as input
+        warped_grid: (Tensor float, shape (N, *sizes, ndim)) sampling grid in x-y-z order
     """
-    ndim = x.ndim - 2
-    size = x.size()[2:]
-    disp = disp.type_as(x)
+    ndim = disp.ndim - 2
+    size = disp.size()[2:]
 
     # normalise disp to [-1, 1]
     disp = normalise_disp(disp)
@@ -246,6 +243,38 @@ def warp(x, disp, interp_mode="bilinear"):
 
     # swapping i-j-k order to x-y-z (k-j-i) order for grid_sample()
     warped_grid = [warped_grid[ndim - 1 - i] for i in range(ndim)]
-    warped_grid = torch.stack(warped_grid, -1)  # (N, *size, dim)
+    return torch.stack(warped_grid, -1)  # (N, *size, dim)
+
+
+def warp(x, disp, interp_mode="bilinear"):
+    """
+    Spatially transform an image by sampling at transformed locations (2D and 3D)
+
+    Args:
+        x: (Tensor float, shape (N, ndim, *sizes)) input image
+        disp: (Tensor float, shape (N, ndim, *sizes)) dense disp field in i-j-k order (NOT spatially normalised)
+        interp_mode: (string) mode of interpolation in grid_sample()
+
+    Returns:
+        deformed x, Tensor of the same shape as input
+    """
+    disp = disp.type_as(x)
+    return F.grid_sample(x, warped_grid(disp), mode=interp_mode, align_corners=False)
+
 
-    return F.grid_sample(x, warped_grid, mode=interp_mode, align_corners=False)
+def warp_stacked(xs, grid, interp_mode="bilinear"):
+    """
+    Spatially transform several images with the same sampling grid in one grid_sample() call
+
+    Args:
+        xs: (list of Tensors, shapes (N, ch_i, *sizes)) input images
+        grid: (Tensor float, shape (N, *sizes, ndim)) sampling grid from `warped_grid()`
+        interp_mode: (string) mode of interpolation in grid_sample()
+
+    Returns:
+        (tuple of Tensors) deformed xs, in the same order and shapes as input
+    """
+    channels = [x.shape[1] for x in xs]
+    x = torch.cat(xs, dim=1).type_as(grid)
+    y = F.grid_sample(x, grid, mode=interp_mode, align_corners=False)
+    return y.split(channels, dim=1)
@@ -51,6 +51,9 @@ def get_loss_fn(hparams):
     elif hparams.loss.sim_loss == 'nmi':
         sim_loss_fn = loss.MILossGaussian(**hparams.loss.mi_config)
 
+    elif hparams.loss.sim_loss == 'nmi_bspline':
+        sim_loss_fn = loss.MILossBSpline(**hparams.loss.mi_config)
+
     else:
         raise ValueError(f'Similarity loss config ({hparams.loss.sim_loss}) not recognised.')
 
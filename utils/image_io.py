@@ -37,6 +37,23 @@ def save_nifti(x, path, nim=None, verbose=False):
         print("Nifti saved to: {}".format(path))
 
 
+def save_nifti_async(x, path, executor, nim=None):
+    """
+    Save a numpy array to a nifti file in a background thread.
+    Gzip compression in zlib releases the GIL, so several files can be compressed in parallel.
+
+    Args:
+        x: (numpy.ndarray) data, must not be modified until the returned future is done
+        path: destination path
+        executor: (concurrent.futures.Executor) executor to run the saving
+        nim: Nibabel nim object, to provide the nifti header
+
+    Returns:
+        (concurrent.futures.Future) future of the saving job
+    """
+    return executor.submit(save_nifti, x, path, nim=nim)
+
+
 def upsample_image(image, size):
     return np.array(Image.fromarray(image).resize((size, size)))
 
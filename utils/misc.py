@@ -9,8 +9,7 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 
 
 def setup_dir(dir_path):
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
     return dir_path
 
 